@@ -1,54 +1,149 @@
+import eventlet
+eventlet.monkey_patch()
+
+import hmac
+import logging
 import secrets
+import sys
 import threading
 import time
+from collections import defaultdict
 from flask import Flask, render_template, request
 from flask_socketio import SocketIO, join_room, leave_room, emit
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'replace-with-a-real-secret'
-socketio = SocketIO(app, cors_allowed_origins="*")
-
-# In-memory rooms structure:
-# rooms[room_id] = {
-#   'host_sid': <sid>,
-#   'client_sid': <sid> or None,
-#   'video_hash': <sha256>,
-#   'filename': <filename>,
-#   'state': {'time': 0.0, 'paused': True},
-#   'last_active': timestamp
-# }
+# msgpack halves signaling payloads (SDP/ICE) vs JSON; the client loads the
+# matching socket.io.msgpack bundle in base.html
+socketio = SocketIO(app, async_mode='eventlet', serializer='msgpack', cors_allowed_origins="*")
+
+# Silent unless the deployment configures logging for 'syncflix'; calls use
+# lazy %-formatting so disabled debug lines cost almost nothing.
+log = logging.getLogger('syncflix')
+log.addHandler(logging.NullHandler())
+
+class Room:
+    """In-memory state for one watch party. Slotted: no per-instance __dict__."""
+    __slots__ = ('host_sid', 'client_sid', 'video_hash', 'filename',
+                 'time', 'paused', 'last_active', 'last_sig')
+
+    def __init__(self, host_sid, video_hash, filename):
+        self.host_sid = host_sid
+        self.client_sid = None
+        self.video_hash = video_hash  # hash_bytes() of the file's sha256
+        self.filename = filename
+        self.time = 0.0
+        self.paused = True
+        self.last_active = NOW
+        self.last_sig = None  # (target, paused, time) of the last sync_state sent
+
+    def state(self):
+        """Playback state as sent in sync_state."""
+        return {'time': self.time, 'paused': self.paused}
+
+# rooms[room_id] = Room
 rooms = {}
-room_locks = {}
+# Reverse index so disconnects don't have to scan every room:
+# sid_to_room[sid] = (room_id, 'host' | 'client')
+sid_to_room = {}
+# One TTL timer per room that is missing a participant; rooms with nobody
+# left are deleted right away in handle_disconnect.
+room_timers = {}
+# Latest heartbeat per room waiting to be flushed:
+# pending_state[room_id] = (time, paused, target_sid, monotonic capture time)
+pending_state = {}
+# ICE candidates waiting to be forwarded: pending_ice[room_id] = [(target_sid, candidate)]
+pending_ice = defaultdict(list)
 
-ROOM_TTL_SECONDS = 60 * 60  # 1 hour (unused users will get removed if both gone)
+ROOM_TTL_SECONDS = 60 * 60  # 1 hour (half-empty rooms expire after this much inactivity)
+STATE_FLUSH_SECONDS = 0.1  # heartbeat coalescing window
+ICE_FLUSH_SECONDS = 0.02  # ICE candidate batching window
 
-def generate_room_id():
-    # Longer, unguessable id for production-like security
-    return secrets.token_urlsafe(12)
+# Coarse monotonic clock in whole seconds, advanced by ticker() so event
+# handlers can stamp last_active without a clock syscall each time.
+NOW = int(time.monotonic())
 
-def cleanup_worker():
+def ticker():
+    global NOW
     while True:
-        now = time.time()
-        to_delete = []
-        for rid, meta in list(rooms.items()):
-            if meta.get('host_sid') is None and meta.get('client_sid') is None:
-                # If no participants, delete
-                to_delete.append(rid)
-            else:
-                # optional: expire rooms older than TTL since last_active
-                if now - meta.get('last_active', now) > ROOM_TTL_SECONDS:
-                    to_delete.append(rid)
-        for rid in to_delete:
-            try:
-                del rooms[rid]
-                del room_locks[rid]
-                print(f"[cleanup] removed room {rid}")
-            except KeyError:
-                pass
-        time.sleep(60)
-
-cleanup_thread = threading.Thread(target=cleanup_worker, daemon=True)
-cleanup_thread.start()
+        NOW = int(time.monotonic())
+        socketio.sleep(1)
+
+socketio.start_background_task(ticker)
+
+# control actions, interned so handle_control can compare by identity
+PLAY, PAUSE, SEEK = map(sys.intern, ('play', 'pause', 'seek'))
+
+def generate_room_id():
+    # 80 random bits: unguessable, and collisions are negligible, so callers
+    # don't need to check for an existing room
+    return secrets.token_urlsafe(10)
+
+def hash_bytes(video_hash):
+    """Compact bytes form of a client-supplied video hash (raw digest for sha256 hex)."""
+    if len(video_hash) == 64:
+        try:
+            return bytes.fromhex(video_hash)
+        except ValueError:
+            pass
+    return video_hash.encode()
+
+def delete_room(room_id):
+    """Drop a room and everything indexed by it."""
+    cancel_room_expiry(room_id)
+    meta = rooms.pop(room_id, None)
+    pending_state.pop(room_id, None)
+    pending_ice.pop(room_id, None)
+    if meta is None:
+        return
+    for sid in (meta.host_sid, meta.client_sid):
+        # only drop index entries that still point at this room
+        if sid and sid_to_room.get(sid, (None,))[0] == room_id:
+            del sid_to_room[sid]
+    log.debug("cleanup removed room %s", room_id)
+
+def expire_room(room_id):
+    meta = rooms.get(room_id)
+    if meta is None:
+        return
+    idle = NOW - meta.last_active
+    if idle < ROOM_TTL_SECONDS:
+        # touched since the timer was armed, wait out the remainder
+        arm_room_expiry(room_id, ROOM_TTL_SECONDS - idle)
+        return
+    delete_room(room_id)
+
+def arm_room_expiry(room_id, delay=ROOM_TTL_SECONDS):
+    """(Re)start the TTL timer for a room that is waiting on a participant."""
+    cancel_room_expiry(room_id)
+    timer = threading.Timer(delay, expire_room, args=(room_id,))
+    timer.daemon = True
+    room_timers[room_id] = timer
+    timer.start()
+
+def cancel_room_expiry(room_id):
+    timer = room_timers.pop(room_id, None)
+    if timer:
+        timer.cancel()
+
+def release_sid(sid):
+    """Take sid out of the room it is in, if any; returns that room's id."""
+    entry = sid_to_room.pop(sid, None)
+    if not entry:
+        return None
+    room_id, role = entry
+    meta = rooms.get(room_id)
+    if meta is None:
+        return room_id
+    # role is 'host' or 'client', naming the slot to clear
+    setattr(meta, role + '_sid', None)
+    log.debug("room %s %s left", room_id, role)
+    meta.last_active = NOW
+    if meta.host_sid is None and meta.client_sid is None:
+        delete_room(room_id)
+    else:
+        arm_room_expiry(room_id)
+    return room_id
 
 @app.route('/')
 def index():
@@ -67,25 +162,22 @@ def join_page():
 def handle_create_room(data):
     video_hash = data.get('video_hash')
     filename = data.get('filename')
-    if not video_hash or not filename:
+    # msgpack lets clients send any type; hash_bytes() expects a str
+    if not isinstance(video_hash, str) or not video_hash or not filename:
         emit('error', {'message': 'Missing video metadata'})
         return
 
+    # a socket is in at most one room (e.g. a double-submitted create form)
+    prev = release_sid(request.sid)
+    if prev:
+        leave_room(prev)
+
     room_id = generate_room_id()
-    while room_id in rooms:
-        room_id = generate_room_id()
-
-    rooms[room_id] = {
-        'host_sid': request.sid,
-        'client_sid': None,
-        'video_hash': video_hash,
-        'filename': filename,
-        'state': {'time': 0.0, 'paused': True},
-        'last_active': time.time()
-    }
-    room_locks[room_id] = threading.Lock()
+    rooms[room_id] = Room(request.sid, hash_bytes(video_hash), filename)
+    sid_to_room[request.sid] = (room_id, 'host')
+    arm_room_expiry(room_id)
     join_room(room_id)
-    print(f"[room] created {room_id} by {request.sid}")
+    log.debug("room created %s by %s", room_id, request.sid)
     emit('room_created', {'room_id': room_id, 'filename': filename})
 
 @socketio.on('join_room')
@@ -96,60 +188,77 @@ def handle_join_room(data):
         emit('error', {'message': 'Missing room id'})
         return
 
-    if room_id not in rooms:
+    meta = rooms.get(room_id)
+    if meta is None:
         emit('error', {'message': f'Room {room_id} not found'})
         return
 
-    with room_locks[room_id]:
-        if rooms[room_id]['client_sid'] is not None:
-            emit('error', {'message': 'Room is full'})
-            return
-        # Verify video hash
-        if video_hash != rooms[room_id]['video_hash']:
-            emit('error', {'message': 'Video file mismatch! Make sure you selected the same file as the host.'})
-            return
+    # Handlers run cooperatively on a single eventlet worker and nothing
+    # here yields before client_sid is claimed, so no lock is needed.
+    # release_sid() may yield (starting a TTL timer), so it runs after the claim.
+    if sid_to_room.get(request.sid, (None,))[0] == room_id:
+        emit('error', {'message': 'Already in this room'})
+        return
+    if meta.client_sid is not None:
+        emit('error', {'message': 'Room is full'})
+        return
+    # Verify video hash
+    if (not isinstance(video_hash, str)
+            or not hmac.compare_digest(meta.video_hash, hash_bytes(video_hash))):
+        emit('error', {'message': 'Video file mismatch! Make sure you selected the same file as the host.'})
+        return
 
-        rooms[room_id]['client_sid'] = request.sid
-        rooms[room_id]['last_active'] = time.time()
-        join_room(room_id)
-        print(f"[room] {request.sid} joined {room_id}")
-        # send current state to new peer
-        emit('sync_state', rooms[room_id]['state'], room=request.sid)
-        # notify host that peer joined
-        host_sid = rooms[room_id]['host_sid']
-        if host_sid:
-            emit('peer_joined', {'message': 'Peer joined'}, room=host_sid)
-        # tell both ready to start camera/rtc negotiation
-        emit('ready_for_call', room=room_id)
+    meta.client_sid = request.sid
+    prev = release_sid(request.sid)
+    if prev:
+        leave_room(prev)
+    meta.last_active = NOW
+    sid_to_room[request.sid] = (room_id, 'client')
+    cancel_room_expiry(room_id)
+    join_room(room_id)
+    log.debug("room %s joined by %s", room_id, request.sid)
+    # send current state to new peer
+    emit('sync_state', meta.state(), room=request.sid)
+    # notify host that peer joined
+    host_sid = meta.host_sid
+    if host_sid:
+        emit('peer_joined', {'message': 'Peer joined'}, room=host_sid)
+    # tell both ready to start camera/rtc negotiation
+    emit('ready_for_call', room=room_id)
 
 @socketio.on('control')
 def handle_control(data):
     room_id = data.get('room_id')
-    action = data.get('action')
-    time_val = float(data.get('time', rooms.get(room_id, {}).get('state', {}).get('time', 0.0)))
-
-    if not room_id or room_id not in rooms:
+    meta = rooms.get(room_id)
+    if meta is None:
         return
+    action = data.get('action')
+    if isinstance(action, str):
+        action = sys.intern(action)
+    time_val = float(data.get('time', meta.time))
 
-    with room_locks[room_id]:
-        # update canonical state
-        if action == 'play':
-            rooms[room_id]['state']['paused'] = False
-        elif action == 'pause':
-            rooms[room_id]['state']['paused'] = True
-        elif action == 'seek':
-            rooms[room_id]['state']['time'] = time_val
+    # update canonical state
+    if action is PLAY:
+        meta.paused = False
+    elif action is PAUSE:
+        meta.paused = True
 
-        # keep latest time always
-        rooms[room_id]['state']['time'] = time_val
-        rooms[room_id]['last_active'] = time.time()
+    # keep latest time always (this also covers SEEK)
+    meta.time = time_val
+    meta.last_active = NOW
 
-        # route to other participant only (avoid echo)
-        host = rooms[room_id]['host_sid']
-        client = rooms[room_id]['client_sid']
-        target = client if request.sid == host else host
-        if target:
-            emit('sync_state', rooms[room_id]['state'], room=target)
+    # route to other participant only (avoid echo)
+    target = peer_sid(meta)
+    if target:
+        # this state supersedes any heartbeat still waiting to flush
+        pending_state.pop(room_id, None)
+        # while paused, skip no-op updates the peer has already been sent;
+        # while playing the peer's position moves, so a repeat is a real seek
+        sig = (target, meta.paused, round(meta.time, 2))
+        if meta.paused and sig == meta.last_sig:
+            return
+        meta.last_sig = sig
+        emit('sync_state', meta.state(), room=target)
 
 @socketio.on('state_update')
 def handle_state_update(data):
@@ -158,87 +267,110 @@ def handle_state_update(data):
     Should be emitted from host periodically (e.g., every 2s).
     """
     room_id = data.get('room_id')
+    meta = rooms.get(room_id)
+    if meta is None:
+        return
     time_val = float(data.get('time', 0.0))
     paused = bool(data.get('paused', True))
-    if not room_id or room_id not in rooms:
-        return
-    with room_locks[room_id]:
-        rooms[room_id]['state']['time'] = time_val
-        rooms[room_id]['state']['paused'] = paused
-        rooms[room_id]['last_active'] = time.time()
-        # send only to the other participant
-        host = rooms[room_id]['host_sid']
-        client = rooms[room_id]['client_sid']
-        target = client if request.sid == host else host
-        if target:
-            emit('sync_state', rooms[room_id]['state'], room=target)
-
-# WebRTC signaling: offer / answer / ice -------------------------------------
-def route_to_peer(room_id, payload):
-    """Utility: send payload to the other peer (not the sender)."""
-    if room_id not in rooms:
-        return
-    host = rooms[room_id]['host_sid']
-    client = rooms[room_id]['client_sid']
-    target = client if request.sid == host else host
+    meta.time = time_val
+    meta.paused = paused
+    meta.last_active = NOW
+    # send only to the other participant
+    target = peer_sid(meta)
     if target:
-        emit(payload['event'], payload['data'], room=target)
+        # compare at quarter-second steps, below noticeable drift, so a
+        # steady (e.g. paused) host stops producing emits altogether; the
+        # time actually sent stays unrounded
+        if (target, paused, round(time_val * 4) / 4) == meta.last_sig:
+            pending_state.pop(room_id, None)
+            return
+        # coalesce bursts: only the freshest state is sent per window
+        first = room_id not in pending_state
+        pending_state[room_id] = (time_val, paused, target, time.monotonic())
+        if first:
+            socketio.start_background_task(flush_state, room_id)
 
-@socketio.on('offer')
-def handle_offer(data):
-    # data should contain: room_id, offer
-    room_id = data.get('room_id')
-    if not room_id or room_id not in rooms:
+def flush_state(room_id):
+    """Send the latest buffered heartbeat for a room after a short window."""
+    socketio.sleep(STATE_FLUSH_SECONDS)
+    pending = pending_state.pop(room_id, None)
+    meta = rooms.get(room_id)
+    if pending is None or meta is None:
         return
-    payload = {'event': 'offer', 'data': {'room_id': room_id, 'offer': data.get('offer')}}
-    route_to_peer(room_id, payload)
+    time_val, paused, target, captured = pending
+    if not paused:
+        # playback moved on while the heartbeat sat in the buffer
+        time_val += time.monotonic() - captured
+    meta.last_sig = (target, paused, round(time_val * 4) / 4)
+    socketio.emit('sync_state', {'time': time_val, 'paused': paused}, room=target)
 
-@socketio.on('answer')
-def handle_answer(data):
-    room_id = data.get('room_id')
-    if not room_id or room_id not in rooms:
-        return
-    payload = {'event': 'answer', 'data': {'room_id': room_id, 'answer': data.get('answer')}}
-    route_to_peer(room_id, payload)
+# WebRTC signaling: offer / answer / ice -------------------------------------
+def peer_sid(meta):
+    """The sid of the participant in this room that isn't the sender."""
+    return meta.client_sid if request.sid == meta.host_sid else meta.host_sid
+
+def make_relay(event):
+    """Register a handler that forwards `event` (payload key of the same name) to the peer."""
+    @socketio.on(event)
+    def relay(data):
+        room_id = data.get('room_id')
+        meta = rooms.get(room_id)
+        if meta is None:
+            return
+        target = peer_sid(meta)
+        if target:
+            emit(event, {'room_id': room_id, event: data.get(event)}, room=target)
+    return relay
+
+# data should contain: room_id, offer / room_id, answer
+handle_offer = make_relay('offer')
+handle_answer = make_relay('answer')
 
 @socketio.on('ice_candidate')
 def handle_ice_candidate(data):
+    # Browsers trickle a burst of candidates during negotiation; buffer them
+    # briefly and forward each burst as one ice_candidates event.
     room_id = data.get('room_id')
-    candidate = data.get('candidate')
-    if not room_id or room_id not in rooms:
+    meta = rooms.get(room_id)
+    if meta is None:
+        return
+    target = peer_sid(meta)
+    if not target:
+        return
+    pending = pending_ice[room_id]
+    pending.append((target, data.get('candidate')))
+    if len(pending) == 1:
+        socketio.start_background_task(flush_ice, room_id)
+
+def flush_ice(room_id):
+    """Forward the ICE candidates buffered for a room, one event per target."""
+    socketio.sleep(ICE_FLUSH_SECONDS)
+    batch = pending_ice.pop(room_id, [])
+    if room_id not in rooms:
         return
-    payload = {'event': 'ice_candidate', 'data': {'room_id': room_id, 'candidate': candidate}}
-    route_to_peer(room_id, payload)
+    by_target = defaultdict(list)
+    for target, candidate in batch:
+        by_target[target].append(candidate)
+    for target, candidates in by_target.items():
+        socketio.emit('ice_candidates', {'room_id': room_id, 'candidates': candidates}, room=target)
 
 # Chat messages
 @socketio.on('chat_message')
 def handle_chat_message(data):
     room_id = data.get('room_id')
-    msg = data.get('message')
-    sender = request.sid
-    if not room_id or room_id not in rooms:
+    if room_id not in rooms:
         return
-    with room_locks[room_id]:
-        emit('chat_message', {'sender': sender, 'message': msg}, room=room_id)
+    # the sender renders its own line locally, so don't echo it back
+    emit('chat_message', {'sender': request.sid, 'message': data.get('message')},
+         room=room_id, skip_sid=request.sid)
 
 @socketio.on('disconnect')
 def handle_disconnect():
     sid = request.sid
-    print(f"[disconnect] {sid}")
-    for room_id, meta in list(rooms.items()):
-        changed = False
-        if meta.get('host_sid') == sid:
-            meta['host_sid'] = None
-            changed = True
-            print(f"[room] host left {room_id}")
-        if meta.get('client_sid') == sid:
-            meta['client_sid'] = None
-            changed = True
-            print(f"[room] client left {room_id}")
-        if changed:
-            meta['last_active'] = time.time()
-        # If both are gone, we will cleanup in background thread
+    log.debug("disconnect %s", sid)
+    release_sid(sid)
 
 if __name__ == '__main__':
     print("Starting SyncFlix server...")
-    socketio.run(app, debug=True, allow_unsafe_werkzeug=True)
+    # async_mode='eventlet' makes this serve through eventlet.wsgi
+    socketio.run(app, host='0.0.0.0', port=5000)